@@ -57,6 +57,8 @@ def set_defaults(app):
     app.config["mdserver.hostname_prefix"] = "vm"
     app.config["public-keys.default"] = "__NOT_CONFIGURED__"
     app.config["mdserver.port"] = 80
+    app.config["mdserver.server"] = "wsgiref"
+    app.config["mdserver.workers"] = 1
     app.config["mdserver.userdata_dir"] = "/etc/mdserver/userdata"
     app.config["mdserver.userdata_suffixes"] = ":.yaml"
     app.config["mdserver.logfile"] = "/var/log/mdserver.log"
@@ -48,12 +48,14 @@
 #   "last_update": <timestamp>
 # }
 
+import fcntl
 import ipaddress
 import json
 import logging
 import os
 import random
 import time
+from contextlib import contextmanager
 
 logger = logging.getLogger("mdserver.database")
 
@@ -194,6 +196,13 @@ class Database(object):
             return entry["domain_metadata"][key]
         return None
 
+    @classmethod
+    def lock(cls, dbfile):
+        """Return a context manager holding an exclusive lock on the
+        persistent store, for the duration of a load/update/store cycle.
+        """
+        raise NotImplementedError
+
     def _reindex(self):
         """Recreate database indices, normally after an update."""
         raise NotImplementedError
@@ -362,6 +371,27 @@ class JsonDatabase(Database):
         self._refresh_format()
         self._reindex()
 
+    @classmethod
+    @contextmanager
+    def lock(cls, dbfile):
+        """Hold an exclusive fcntl lock against the database file.
+
+        The lock is taken on a separate `<dbfile>.lock` file, since `store()`
+        replaces the database file rather than rewriting it in place. Anything
+        which loads the database, modifies it, and stores it back should do
+        so while holding this lock, so that concurrent updates from other
+        processes aren't lost.
+        """
+        if dbfile is None:
+            yield
+            return
+        with open(dbfile + ".lock", "a") as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
     def _load_dbfile(self, dbfile):
         # handle the transition from the old style plain entry list to the new
         # style metadata plus entry list
@@ -5,39 +5,65 @@
 #
 # Please see the LICENSE.txt file for details.
 
-import xmltodict
+import io
+import xml.etree.ElementTree as ET
 
 from mdserver.database import Database
-from mdserver.util import _removeprefix
+
+
+def _parse_domain(domain):
+    """Parse the domain XML, returning the root element and the set of
+    namespaces bound to the mdserver prefix.
+
+    ElementTree replaces namespace prefixes with the namespace URI, so we need
+    to track the prefix bindings while parsing to find the mdserver metadata.
+    """
+    if isinstance(domain, bytes):
+        source = io.BytesIO(domain)
+    else:
+        source = io.StringIO(domain)
+    md_namespaces = set()
+    parser = ET.iterparse(source, events=("start-ns",))
+    for _, (prefix, uri) in parser:
+        if prefix == "mdserver":
+            md_namespaces.add("{%s}" % uri)
+    return parser.root, md_namespaces
+
+
+def _mds_mac_path(net):
+    """Return an ElementTree path selecting the MAC address element of the
+    interfaces attached to the given network.
+    """
+    quote = '"' if "'" in net else "'"
+    return "devices/interface/source[@network=%s%s%s]/../mac" % (quote, net, quote)
 
 
 def get_domain_data(domain, net):
     """Extract key data from the supplied domain XML.
 
     Data extracted are: the name, uuid, and MAC address from the mds network
-    interface.
+    interface. Returns None if the domain has no interface on the mds network.
     """
 
+    # the hook uploads every domain started on the host, so skip parsing
+    # domains that can't possibly be attached to the mds network
+    needle = net.encode() if isinstance(domain, bytes) else net
+    if needle not in domain:
+        return None
+
     ddata = Database.new_entry()
-    dom = xmltodict.parse(domain)
-    ddata["domain_name"] = dom["domain"]["name"]
-    ddata["domain_uuid"] = dom["domain"]["uuid"]
-    if "metadata" in dom["domain"]:
-        ddata["domain_metadata"] = {
-            _removeprefix(key, "mdserver:"): dom["domain"]["metadata"][key]
-            for key in dom["domain"]["metadata"]
-            if key.startswith("mdserver:")
-        }
-    interfaces = dom["domain"]["devices"]["interface"]
-    if not isinstance(interfaces, list):
-        interfaces = [interfaces]
-    try:
-        mds_interfaces = [
-            i
-            for i in interfaces
-            if "@network" in i["source"] and i["source"]["@network"] == net
-        ]
-        ddata["mds_mac"] = mds_interfaces[0]["mac"]["@address"]
-    except KeyError:
+    dom, md_namespaces = _parse_domain(domain)
+    ddata["domain_name"] = dom.findtext("name")
+    ddata["domain_uuid"] = dom.findtext("uuid")
+    metadata = dom.find("metadata")
+    if metadata is not None:
+        ddata["domain_metadata"] = {}
+        for item in metadata:
+            ns, sep, key = item.tag.rpartition("}")
+            if ns + sep in md_namespaces:
+                ddata["domain_metadata"][key] = item.text
+    mac = dom.find(_mds_mac_path(net))
+    if mac is None:
         return None
+    ddata["mds_mac"] = mac.get("address")
     return ddata
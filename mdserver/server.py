@@ -3,14 +3,23 @@
 #
 # Please see the LICENSE.txt file for details.
 
+import importlib
 import logging
 import os
+import re
+import signal
+import socket
 import sys
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from functools import wraps
+from wsgiref.simple_server import WSGIServer
 
 import bottle
+from bottle import TEMPLATE_PATH
+from bottle import SimpleTemplate
 from bottle import abort
 from bottle import error
 from bottle import install
@@ -18,7 +27,6 @@ from bottle import request
 from bottle import response
 from bottle import route
 from bottle import run
-from bottle import template
 
 import mdserver.config as mds_config
 from mdserver.database import JsonDatabase as Database
@@ -37,9 +45,48 @@ ssh_authorized_keys:
     - {{public_key_default}}
 """
 
+# log level names accepted in the [loglevels] config section
+LOGLEVELS = {
+    "CRITICAL": logging.CRITICAL,
+    "FATAL": logging.FATAL,
+    "ERROR": logging.ERROR,
+    "WARNING": logging.WARNING,
+    "WARN": logging.WARNING,
+    "INFO": logging.INFO,
+    "DEBUG": logging.DEBUG,
+    "NOTSET": logging.NOTSET,
+}
+
+# WSGI servers that mdserver can't run under - gevent needs the standard
+# library monkey patched before anything else is imported
+UNSUPPORTED_SERVERS = frozenset(["gevent"])
+
+# the modules each of bottle's server adapters imports when it's run, so that
+# we can check that the selected server is installed before starting up
+SERVER_MODULES = {
+    "flup": ["flup.server.fcgi"],
+    "waitress": ["waitress"],
+    "cherrypy": ["cherrypy"],
+    "cheroot": ["cheroot.wsgi"],
+    "paste": ["paste.httpserver", "paste.translogger"],
+    "fapws3": ["fapws._evwsgi"],
+    "tornado": ["tornado.wsgi"],
+    "gae": ["google.appengine.ext.webapp"],
+    "twisted": ["twisted.web.wsgi"],
+    "diesel": ["diesel.protocols.wsgi"],
+    "meinheld": ["meinheld"],
+    "gunicorn": ["gunicorn.app.base"],
+    "eventlet": ["eventlet"],
+    "bjoern": ["bjoern"],
+    "aiohttp": ["aiohttp_wsgi.wsgi"],
+    "uvloop": ["aiohttp_wsgi.wsgi", "uvloop"],
+}
 
 logger = logging.getLogger("mdserver")
 
+# used to write out debug userdata without holding up the response
+debug_writer = ThreadPoolExecutor(max_workers=1)
+
 
 def early_logging():
     """Set up an early logging mechanism."""
@@ -54,6 +101,34 @@ def early_logging():
     early_logger.addHandler(stdout_log)
 
 
+def get_loglevel(config, key):
+    """Return the (upper case) log level name set by the given config key,
+    falling back to INFO if the name isn't recognised.
+    """
+    level = config[key].upper()
+    if level not in LOGLEVELS:
+        early_logger = logging.getLogger("early_logger")
+        early_logger.warning("Unknown log level %s for %s, using INFO", level, key)
+        level = "INFO"
+    return level
+
+
+def check_server(server):
+    """Check that the named WSGI server can be used, returning None if it can,
+    or an error message if it can't.
+    """
+    if server in UNSUPPORTED_SERVERS:
+        return "The %s server is not supported" % (server)
+    if server not in bottle.server_names:
+        return "Unknown server %s" % (server)
+    for module in SERVER_MODULES.get(server, []):
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            return "The %s server is not available: %s" % (server, e)
+    return None
+
+
 def log_to_logger(fn):
     """
     Wrap a Bottle request so that a log line is emitted after it's handled.
@@ -62,63 +137,329 @@ def log_to_logger(fn):
 
     @wraps(fn)
     def _log_to_logger(*args, **kwargs):
-        request_time = datetime.now()
+        # skip the timing and request attribute lookups entirely if the log
+        # line would be dropped anyway
+        if not logger.isEnabledFor(logging.INFO):
+            return fn(*args, **kwargs)
+        # the formatter already timestamps the log line, so we only need to
+        # track how long the request took
+        start = time.monotonic_ns()
         actual_response = fn(*args, **kwargs)
+        elapsed_us = (time.monotonic_ns() - start) // 1000
         # modify this to log exactly what you need:
         logger.info(
-            "%s %s %s %s %s",
+            "%s %s %s %s %dus",
             request.remote_addr,
-            request_time,
             request.method,
             request.url,
             response.status,
+            elapsed_us,
         )
         return actual_response
 
     return _log_to_logger
 
 
+def _read_template(name):
+    with open(name, "r") as tf:
+        return tf.read()
+
+
+@lru_cache(maxsize=128)
+def _read_template_cached(name, mtime, size):
+    return _read_template(name)
+
+
+def read_template(name):
+    """Return the contents of the named template file.
+
+    File contents are cached keyed on the file's modification time and size,
+    so the file is only read again when it has been changed. Files modified
+    within the last second aren't cached, since templates are edited in place
+    and a second edit in the same timestamp tick might not change the key.
+    """
+    st = os.stat(name)
+    if time.time_ns() - st.st_mtime_ns <= 1000000000:
+        return _read_template(name)
+    return _read_template_cached(name, st.st_mtime_ns, st.st_size)
+
+
+@lru_cache(maxsize=64)
+def compile_template(source):
+    """Return a compiled template for the supplied template source.
+
+    Compiled templates are cached keyed on their source, so a template is
+    only parsed once no matter how many times it's rendered.
+    """
+    return SimpleTemplate(source=source, lookup=TEMPLATE_PATH)
+
+
+def write_debug_userdata(udata_path, user_data):
+    """Write the rendered user_data out to udata_path for debugging."""
+    try:
+        with open(udata_path, "w") as udf:
+            udf.write(user_data)
+        logger.debug("Wrote user_data to %s", udata_path)
+    except OSError as e:
+        logger.warning("Failed to write user_data to %s: %s", udata_path, e)
+
+
+class DnsmasqUpdater(object):
+    """Regenerate the dnsmasq host files from the database in a background
+    thread, and HUP dnsmasq to pick up the changes.
+
+    Update requests are coalesced: all requests made while an update is
+    pending are handled by a single regeneration, which starts `delay`
+    seconds after the first request and uses the database as it is at that
+    point.
+
+    The host files are only rewritten, and dnsmasq HUPed, if the host data in
+    the database has changed since the last update.
+    """
+
+    def __init__(self, config, delay=0.2):
+        self.config = config
+        self.delay = delay
+        self._hosts = None
+        self._pending = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def request(self):
+        """Request an update of the dnsmasq host files."""
+        # the thread is started on demand, since worker processes are forked
+        # after this object is created, and threads don't survive a fork
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="dnsmasq-updater", daemon=True
+                )
+                self._thread.start()
+        self._pending.set()
+
+    def update(self):
+        """Regenerate the dnsmasq host files and HUP dnsmasq."""
+        db_file = self.config["mdserver.db_file"]
+        dnsmasq = Dnsmasq(self.config)
+        with Database.lock(db_file):
+            db = Database(db_file)
+            # only the fields used to generate the host files matter here
+            hosts = [
+                (e["domain_name"], e["mds_mac"], e["mds_ipv4"], e["mds_ipv6"])
+                for e in db
+            ]
+            if hosts == self._hosts:
+                logger.debug("Host data unchanged, skipping dnsmasq update")
+                return
+            dnsmasq.gen_dhcp_hosts(db)
+            dnsmasq.gen_dns_hosts(db)
+        dnsmasq.hup()
+        self._hosts = hosts
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            time.sleep(self.delay)
+            # anything requested after this point needs another update
+            self._pending.clear()
+            try:
+                self.update()
+            except Exception as e:
+                logger.error("Failed to update dnsmasq host files: %s", e)
+
+
+class ReusePortWSGIServer(WSGIServer):
+    """A WSGIServer which binds its socket with SO_REUSEPORT set, allowing
+    multiple worker processes to listen on the same address and port, with
+    the kernel distributing incoming connections between them.
+    """
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def run_workers(host, port, workers):
+    """Run the server in multiple worker processes.
+
+    Each worker is forked from this process and binds its own listening socket
+    using SO_REUSEPORT; this process then acts as a simple supervisor, waiting
+    on the workers and passing on any SIGTERM or SIGINT it receives. If any
+    worker exits unexpectedly the remaining workers are stopped, so that the
+    service as a whole fails rather than carrying on with fewer workers.
+
+    Returns True if all the workers exited cleanly, False otherwise.
+    """
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # only a normal return from run() counts as a clean exit
+            status = 1
+            try:
+                run(host=host, port=port, server_class=ReusePortWSGIServer)
+                status = 0
+            except Exception:
+                logger.exception("Worker %d failed", os.getpid())
+            finally:
+                os._exit(status)
+        children.append(pid)
+    logger.info("Started %d workers: %s", workers, children)
+
+    running = set(children)
+    # the signals we've passed on to the workers - a worker killed by one of
+    # these after we passed it on is shutting down normally
+    terminating = []
+
+    def _terminate(signum, frame):
+        terminating.append(signum)
+        for pid in list(running):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, _terminate)
+    signal.signal(signal.SIGINT, _terminate)
+    clean = True
+    while len(running) > 0:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except ChildProcessError:
+            break
+        if pid not in running:
+            continue
+        running.discard(pid)
+        if os.WIFSIGNALED(status):
+            if os.WTERMSIG(status) in terminating:
+                continue
+            logger.error("Worker %d killed by signal %d", pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            logger.error("Worker %d exited with status %d", pid, os.WEXITSTATUS(status))
+        elif len(terminating) > 0:
+            continue
+        else:
+            logger.error("Worker %d exited unexpectedly", pid)
+        clean = False
+        if len(terminating) == 0:
+            logger.error("Stopping remaining workers: %s", sorted(running))
+            _terminate(signal.SIGTERM, None)
+    return clean
+
+
 class MetadataHandler(object):
+    # static directory listings, which never change. Precomputed responses
+    # are stored as bytes, which bottle passes through without re-encoding.
+    base_content = b"\n".join([b"meta-data/", b"user-data"])
+    metadata_content = b"\n".join([b"instance-id", b"hostname", b"public-keys/"])
+    service_info_content = b"\n".join(
+        [
+            b"name",
+            b"type",
+            b"version",
+            b"location",
+            b"ec2_versions",
+        ]
+    )
+
     def __init__(self):
         self.default_template = USERDATA_TEMPLATE
         self.public_keys = {}
+        self.public_key_data = {}
+        self.public_keys_content = b""
+        self.config_content = b""
+        self.ec2_versions = []
+        self.versions_content = b""
+        self.ec2_versions_content = b""
+        self.template_data_keys = []
+        self.template_config_items = []
+        self.userdata_suffixes = ("",)
+        self.template_context = {}
+        self._db = None
+        self._db_version = None
+        self._userdata_dirs = {}
+        self.dnsmasq_updater = None
 
     def _set_public_keys(self, config):
-        # we store the public key name here, and use tht to retrieve the
-        # actual key strig from the config when it's required
+        # we store the public key name here, and map both the key name and
+        # the key index to the actual key string, so that key requests only
+        # need a single lookup
         keys = [k.split(".")[1] for k in config if k.startswith("public-keys")]
         for i, k in enumerate(keys):
             self.public_keys[i] = k
+            self.public_key_data[k] = config["public-keys." + k].encode("utf-8")
+        # key indices take precedence over key names
+        for i, k in self.public_keys.items():
+            self.public_key_data[str(i)] = self.public_key_data[k]
+        self.public_keys_content = "\n".join(
+            ["{}={}".format(i, k) for i, k in self.public_keys.items()]
+        ).encode("utf-8")
+
+    def _db_file_version(self, dbfile):
+        # the database is stored by renaming a new file into place, but inode
+        # numbers get reused (successive stores often alternate between two),
+        # so two stores within the filesystem's timestamp granularity can
+        # leave the inode, mtime and size all unchanged. A file changed within
+        # the last second has no reliable version, so we return None and it
+        # is always reloaded - as is a missing file.
+        try:
+            st = os.stat(dbfile)
+        except FileNotFoundError:
+            return None
+        if time.time_ns() - st.st_mtime_ns <= 1000000000:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _get_db(self, config):
+        # the database is shared between requests, and only reloaded when the
+        # database file changes - this picks up updates from other workers or
+        # other mdservers sharing the database. Note that we stat the file
+        # before loading it, so that a racing update can only cause an extra
+        # reload rather than leaving us with stale data.
+        dbfile = config["mdserver.db_file"]
+        version = self._db_file_version(dbfile)
+        if self._db is None or version is None or version != self._db_version:
+            self._db = Database(dbfile)
+            self._db_version = version
+        return self._db
+
+    def _set_db(self, db, config):
+        # called with the database lock held, after storing an update
+        self._db_version = self._db_file_version(config["mdserver.db_file"])
+        self._db = db
 
     def _set_default_template(self, template_file):
         try:
-            tf = open(template_file, "r")
-            self.default_template = tf.read()
-            tf.close()
+            with open(template_file, "r") as tf:
+                self.default_template = tf.read()
         except IOError:
             logger.error(
                 "Default template file specified (%s), but file not found!",
                 template_file,
             )
 
+    def _get_client(self, what):
+        """Return the address of the client making the current request,
+        logging what it's asking for.
+        """
+        client_host = bottle.request.environ.get("REMOTE_ADDR")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Getting %s for %s", what, client_host)
+        return client_host
+
     def gen_versions(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting versions for %s", client_host)
-        config = bottle.request.app.config
-        versions = [v + "/" for v in self._get_ec2_versions(config)]
-        return self.make_content(versions)
+        self._get_client("versions")
+        return self.versions_content
 
     def gen_base(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting base for %s", client_host)
+        self._get_client("base")
 
-        return self.make_content(["meta-data/", "user-data"])
+        return self.base_content
 
     def gen_metadata(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting metadata for %s", client_host)
+        self._get_client("metadata")
 
-        return self.make_content(["instance-id", "hostname", "public-keys/"])
+        return self.metadata_content
 
     # See if we can find a userdata template file (which may be a plain
     # cloud-init config) in the userdata directory. Files are named
@@ -130,27 +471,47 @@ class MetadataHandler(object):
     # prefix to search for. If set it specifies the filename (minus suffix) to
     # look for, bypassing the normal search list.
     def _try_userdata_template(self, prefix, client_host, config):
-        userdata_dir = config["mdserver.userdata_dir"]
-        userdata_suffixes = config["mdserver.userdata_suffixes"]
-        for sfx in userdata_suffixes.split(":"):
-            name = os.path.join(userdata_dir, prefix) + sfx
-            if os.path.exists(name):
+        base = os.path.join(config["mdserver.userdata_dir"], prefix)
+        dirname, stem = os.path.split(base)
+        names = self._list_userdata_dir(dirname)
+        for sfx in self.userdata_suffixes:
+            if stem + sfx in names:
+                name = base + sfx
                 logger.debug("Found userdata for %s at %s", client_host, name)
                 return name
         return None
 
+    # Return the set of file names in a userdata directory. Listings are
+    # cached keyed on the directory's mtime, which changes whenever an entry
+    # is added, removed or renamed, so we only need to stat the directory
+    # rather than probing for every candidate file. Listings taken within a
+    # second of the last change aren't cached, since another change in the
+    # same second might not alter the mtime on filesystems with coarse
+    # timestamps.
+    def _list_userdata_dir(self, dirname):
+        try:
+            mtime = os.stat(dirname).st_mtime_ns
+        except FileNotFoundError:
+            return frozenset()
+        cached = self._userdata_dirs.get(dirname)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with os.scandir(dirname) as entries:
+            names = frozenset(e.name for e in entries if e.is_file())
+        if time.time_ns() - mtime > 1000000000:
+            self._userdata_dirs[dirname] = (mtime, names)
+        return names
+
     # we shouldn't get to this point without a valid database entry
-    def _get_userdata_template(self, client_host, config):
+    def _get_userdata_template(self, client_host, domain, config):
         hostname = config["hostname"]
-        db = Database(config["mdserver.db_file"])
-        domain = db.query("mds_ipv4", client_host)
         # if we have the userdata prefix metadata set we fail if resolving
         # the userdata template using this doesn't work.
-        ud_p = db._get_entry_metadata(domain, "userdata_prefix")
+        ud_p = Database._get_entry_metadata(domain, "userdata_prefix")
         if ud_p is not None:
             name = self._try_userdata_template(ud_p, client_host, config)
             if name is not None:
-                return open(name).read()
+                return read_template(name)
             logger.debug(
                 "Domain specified userdata prefix %s failed for %s (%s)",
                 ud_p,
@@ -165,32 +526,60 @@ class MetadataHandler(object):
         for prefix in prefixes:
             name = self._try_userdata_template(prefix, client_host, config)
             if name is not None:
-                return open(name).read()
-        return self.make_content(self.default_template)
+                return read_template(name)
+        return self.default_template
 
         logger.debug("Userdata not found for %s", hostname)
         abort(404, "Userdata not found for %s" % (client_host))
 
+    def _set_userdata_suffixes(self, config):
+        self.userdata_suffixes = tuple(config["mdserver.userdata_suffixes"].split(":"))
+
+    def _set_template_data(self, config):
+        # the set of template-data keys and config items is fixed once the
+        # config is loaded, so we only need to find them once
+        self.template_data_keys = [
+            k.split(".")[1] for k in config if k.startswith("template-data")
+        ]
+        self.template_config_items = []
+        if "template-data._config_items_" in config:
+            items = config["template-data._config_items_"].split(",")
+            self.template_config_items = [i for i in items if i in config]
+
     def _get_template_data(self, config):
-        keys = [k.split(".")[1] for k in config if k.startswith("template-data")]
         # make sure that we can't overwrite a core config element
-        for key in keys:
+        for key in self.template_data_keys:
             if key not in config:
                 config[key] = config["template-data." + key]
-        if "template-data._config_items_" in config:
-            # copy these items from the rest of the configuration, eliding the
-            # section name - i.e. dnsmasq.prefix becomes prefix
-            for item in config["template-data._config_items_"].split(","):
-                if item in config:
-                    key = item.split(".")[1]
-                    if key not in config:
-                        config[key] = config[item]
+        # copy these items from the rest of the configuration, eliding the
+        # section name - i.e. dnsmasq.prefix becomes prefix
+        for item in self.template_config_items:
+            key = item.split(".")[1]
+            if key not in config:
+                config[key] = config[item]
         return config
 
+    def _set_template_context(self, config):
+        # everything passed to the userdata template apart from the hostname
+        # is fixed once the config is loaded, so we build it once here.
+        #
+        # Note: _get_public_keys() and _get_template_data() rewrite the
+        # contents of context, hence this chain of calls.
+        context = dict(config)
+        context = self._get_public_keys(context)
+        context = self._get_template_data(context)
+        if context["mdserver.password"]:
+            context["mdserver_password"] = context["mdserver.password"]
+        self.template_context = context
+
+    def _set_config_content(self, app):
+        # the configuration doesn't change once the server is running, so the
+        # dump is generated once rather than on every request
+        self.config_content = "\n".join(mds_config.dump(app)).encode("utf-8")
+
     def _get_public_keys(self, config):
-        keys = [k.split(".")[1] for k in config if k.startswith("public-keys")]
         pkeys = {}
-        for key in keys:
+        for key in self.public_keys.values():
             pkeys[key] = config["public-keys." + key]
             config["public_key_" + key] = config["public-keys." + key]
         if len(pkeys) > 0:
@@ -198,44 +587,42 @@ class MetadataHandler(object):
         return config
 
     def gen_userdata(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        config = bottle.request.app.config
-        logger.debug("Getting userdata for %s", client_host)
-        hostname = self._get_hostname(client_host, config)
-        if hostname is None:
+        client_host = self._get_client("userdata")
+        # we add the hostname to the template context, so work on a copy -
+        # requests may be handled concurrently
+        config = dict(self.template_context)
+        entry = self._get_entry(client_host, config)
+        if entry is None:
             abort(400)
+        hostname = entry["domain_name"]
         config["hostname"] = hostname
 
-        # Note: _get_public_keys() and _get_template_data() rewrite the
-        # contents of config, hence this chain of calls.
-        config = self._get_public_keys(config)
-        config = self._get_template_data(config)
-        if config["mdserver.password"]:
-            config["mdserver_password"] = config["mdserver.password"]
-        user_data_template = self._get_userdata_template(client_host, config)
+        user_data_template = self._get_userdata_template(client_host, entry, config)
         try:
-            user_data = template(user_data_template, **config)
+            user_data = compile_template(user_data_template).render(**config)
         except Exception as e:
             logger.error("Exception %s: template for %s failed?", e, hostname)
             abort(500, "Userdata templating failure for %s" % (hostname))
         if strtobool(config["mdserver.debug_userdata"]):
             udata_path = os.path.join("/tmp", client_host + ".userdata")
-            with open(udata_path, "w") as udf:
-                udf.write(user_data)
-                logger.debug("Wrote user_data to %s", udata_path)
-        return self.make_content(user_data)
+            debug_writer.submit(write_debug_userdata, udata_path, user_data)
+        return user_data
 
-    def _get_hostname(self, client_host, config):
-        db = Database(config["mdserver.db_file"])
+    def _get_entry(self, client_host, config):
+        db = self._get_db(config)
         entry = db.query("mds_ipv4", client_host)
         if entry is None:
             logger.info("Failed to find MAC for %s in database", client_host)
+        return entry
+
+    def _get_hostname(self, client_host, config):
+        entry = self._get_entry(client_host, config)
+        if entry is None:
             return None
         return entry["domain_name"]
 
     def gen_hostname(self):
-        client_ip = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting hostname for %s", client_ip)
+        client_ip = self._get_client("hostname")
         config = bottle.request.app.config
         name = self._get_hostname(client_ip, config)
         if name is None:
@@ -243,116 +630,85 @@ class MetadataHandler(object):
         return name
 
     def gen_public_keys(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting public keys for %s", client_host)
+        self._get_client("public keys")
 
-        keys = ["{}={}".format(i, k) for i, k in self.public_keys.items()]
-        return self.make_content(keys)
+        return self.public_keys_content
 
     def gen_public_key_dir(self, key):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting public key directory for %s", client_host)
+        self._get_client("public key directory")
         res = ""
-        if int(key) in self.public_keys:
-            res = "openssh-key"
-        elif key in self.public_keys.values():
-            # technically this shouldn't work, but it doesn't hurt, I think
+        # technically key names shouldn't work here, only indices, but it
+        # doesn't hurt, I think
+        if key in self.public_key_data:
             res = "openssh-key"
         else:
             abort(404, "Not found")
-        return self.make_content(res)
+        return res
 
     def gen_public_key_file(self, key="default"):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting public key file for %s", client_host)
-        # if we have one of the key indices, map it to a key name, otherwise
-        # just look for the key by name
-        if int(key) in self.public_keys:
-            key = self.public_keys[int(key)]
-        res = bottle.request.app.config["public-keys.%s" % key]
-        return self.make_content(res)
+        self._get_client("public key file")
+        # the key may be either a key index or a key name
+        res = self.public_key_data.get(key)
+        if res is None:
+            abort(404, "Not found")
+        return res
 
     def gen_instance_id(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting instance-id for %s", client_host)
-        iid = "i-%s" % client_host
-        return self.make_content(iid)
+        client_host = self._get_client("instance-id")
+        return "i-" + client_host
 
     def gen_service_info(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting service info for %s", client_host)
-        return self.make_content(
-            [
-                "name",
-                "type",
-                "version",
-                "location",
-                "ec2_versions",
-            ]
-        )
+        self._get_client("service info")
+        return self.service_info_content
 
     def gen_service_name(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting service name for %s", client_host)
+        self._get_client("service name")
         config = bottle.request.app.config
-        return self.make_content(config["service.name"])
+        return config["service.name"]
 
     def gen_service_type(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting service type for %s", client_host)
+        self._get_client("service type")
         config = bottle.request.app.config
-        return self.make_content(config["service.type"])
+        return config["service.type"]
 
     def gen_service_location(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting service location for %s", client_host)
+        self._get_client("service location")
         config = bottle.request.app.config
-        return self.make_content(config["service.location"])
+        return config["service.location"]
 
     def gen_service_version(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting service version for %s", client_host)
+        self._get_client("service version")
         config = bottle.request.app.config
         vstring = "{version} ({release_date})".format(
             version=config["service.version"],
             release_date=config["service.release_date"],
         )
-        return self.make_content(vstring)
+        return vstring
 
     def gen_service_config(self):
         """Dump the service configuration, to support coordination with other
         services on the local node."""
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting service config for %s", client_host)
+        client_host = self._get_client("service config")
         app = bottle.request.app
         # only allow config dump from the local host
         if client_host != app.config["mdserver.listen_address"]:
             abort(401, "access denied")
-        config_strings = mds_config.dump(app)
-        return self.make_content(config_strings)
+        return self.config_content
 
     def gen_ec2_versions(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
-        logger.debug("Getting EC2 versions for %s", client_host)
-        config = bottle.request.app.config
-        return self.make_content(self._get_ec2_versions(config))
-
-    def make_content(self, res):
-        # note that we only test against str here - this excludes unicode
-        # strings on python2, but nothing we're doing here should be unicode
-        # so we can safely ignore that
-        if isinstance(res, list):
-            return "\n".join(res)
-        elif isinstance(res, str):
-            return "%s" % res
-
-    def _get_ec2_versions(self, config):
+        self._get_client("EC2 versions")
+        return self.ec2_versions_content
+
+    def _set_ec2_versions(self, config):
         vraw = config["service.ec2_versions"].split(",")
-        versions = [v.strip() for v in vraw if len(v.strip()) > 0]
-        return versions
+        self.ec2_versions = [v.strip() for v in vraw if len(v.strip()) > 0]
+        # the version listings are fixed once the config is loaded
+        versions = "\n".join([v + "/" for v in self.ec2_versions])
+        self.versions_content = versions.encode("utf-8")
+        self.ec2_versions_content = "\n".join(self.ec2_versions).encode("utf-8")
 
     def instance_upload(self):
-        client_host = bottle.request.get("REMOTE_ADDR")
+        client_host = bottle.request.environ.get("REMOTE_ADDR")
         config = bottle.request.app.config
         # for whatever reason, the source address ends up being the same as
         # the listen address when connections are coming from localhost
@@ -362,6 +718,12 @@ class MetadataHandler(object):
         logger.debug("Got instance upload with data %s", data[0:25])
         # new default entry pre-filled with the domain data
         dbentry = get_domain_data(data, config["dnsmasq.net_name"])
+        if dbentry is None:
+            logger.info(
+                "Ignoring instance upload: no interface on network %s",
+                config["dnsmasq.net_name"],
+            )
+            return ""
         logger.info(
             "Got instance upload: %s (%s)",
             dbentry["domain_name"],
@@ -369,37 +731,40 @@ class MetadataHandler(object):
         )
         # update the entry with anything that needs updating
         dbentry["location"] = config["service.location"]
-        # and actually update the database
-        db = Database(config["mdserver.db_file"])
-        entry = db.add_or_update_entry(dbentry)
-        # if there's no ipv4 address allocated we need to fix that, and update
-        # the database again
-        if entry["mds_ipv4"] is None:
-            entry["mds_ipv4"] = db.gen_ip(
-                config["dnsmasq.net_address"],
-                config["dnsmasq.net_prefix"],
-                exclude=[config["dnsmasq.gateway"]],
-            )
+        # and actually update the database - other workers (or other
+        # mdservers sharing the database) may be doing the same, so hold the
+        # lock while we update it
+        with Database.lock(config["mdserver.db_file"]):
+            db = Database(config["mdserver.db_file"])
+            entry = db.add_or_update_entry(dbentry)
+            # if there's no ipv4 address allocated we need to fix that, and
+            # update the database again
             if entry["mds_ipv4"] is None:
-                logger.warning(
-                    "Failed to allocate address for %s", entry["domain_name"]
+                entry["mds_ipv4"] = db.gen_ip(
+                    config["dnsmasq.net_address"],
+                    config["dnsmasq.net_prefix"],
+                    exclude=[config["dnsmasq.gateway"]],
                 )
-            db.add_or_update_entry(entry)
-        db.store()
-        dnsmasq = Dnsmasq(config)
-        dnsmasq.gen_dhcp_hosts(db)
-        dnsmasq.gen_dns_hosts(db)
-        dnsmasq.hup()
+                if entry["mds_ipv4"] is None:
+                    logger.warning(
+                        "Failed to allocate address for %s", entry["domain_name"]
+                    )
+                db.add_or_update_entry(entry)
+            db.store()
+            self._set_db(db, config)
+        # the dnsmasq config is updated in the background, so we don't keep
+        # the client waiting
+        self.dnsmasq_updater.request()
 
     # error handlers, so we have a cleaner presentation of the common errors
     @error(400)
     def error400(error):
-        client_host = bottle.request.get("REMOTE_ADDR")
+        client_host = bottle.request.environ.get("REMOTE_ADDR")
         return "Unknown client: %s" % (client_host)
 
     @error(401)
     def error401(error):
-        client_host = bottle.request.get("REMOTE_ADDR")
+        client_host = bottle.request.environ.get("REMOTE_ADDR")
         return "Unauthorised client: %s" % (client_host)
 
     @error(404)
@@ -410,6 +775,40 @@ class MetadataHandler(object):
         return "Resource not found: %s" % (body)
 
 
+def add_metadata_routes(app, mdh):
+    """Register the metadata routes for each of the configured EC2 versions
+    on the given app, handled by the given MetadataHandler.
+    """
+    # metadata routes, relative to the EC2 version base path
+    md_routes = [
+        ("/", mdh.gen_base),
+        ("/meta-data/", mdh.gen_metadata),
+        ("/user-data", mdh.gen_userdata),
+        ("/meta-data/hostname", mdh.gen_hostname),
+        ("/meta-data/instance-id", mdh.gen_instance_id),
+        ("/meta-data/public-keys/", mdh.gen_public_keys),
+    ]
+    md_key_routes = [
+        ("/meta-data/public-keys/<key>/", mdh.gen_public_key_dir),
+        ("/meta-data/public-keys/<key>/openssh-key", mdh.gen_public_key_file),
+    ]
+
+    # Note that we skip empty strings - it makes no sense to put metadata
+    # directly under /
+    md_bases = [v.lstrip("/") for v in mdh.ec2_versions if len(v.lstrip("/")) > 0]
+    if len(md_bases) > 0:
+        # routes without wildcards are registered for each EC2 version, since
+        # bottle matches static routes with a single dict lookup
+        for base in md_bases:
+            for path, callback in md_routes:
+                app.route("/" + base + path, "GET", callback)
+        # the public key routes are registered once for all EC2 versions, with
+        # the version part of the path matched by an (anonymous) regex wildcard
+        md_base = "/<:re:%s>" % "|".join(re.escape(v) for v in md_bases)
+        for path, callback in md_key_routes:
+            app.route(md_base + path, "GET", callback)
+
+
 def main():
     early_logging()
     elog = logging.getLogger("early_logger")
@@ -433,12 +832,12 @@ def main():
     #
     # However, if debug is set, then we set the stdout log level to DEBUG
     # unconditionally.
-    base_level = app.config["loglevels.base"].upper()
-    stream_level = app.config["loglevels.stream"].upper()
-    file_level = app.config["loglevels.file"].upper()
-    base_loglevel = getattr(logging, base_level)
-    stream_loglevel = getattr(logging, stream_level)
-    file_loglevel = getattr(logging, file_level)
+    base_level = get_loglevel(app.config, "loglevels.base")
+    stream_level = get_loglevel(app.config, "loglevels.stream")
+    file_level = get_loglevel(app.config, "loglevels.file")
+    base_loglevel = LOGLEVELS[base_level]
+    stream_loglevel = LOGLEVELS[stream_level]
+    file_loglevel = LOGLEVELS[file_level]
     # set up the logger
     elog.info("Base loglevel: %s", base_level)
     logger.setLevel(base_loglevel)
@@ -468,24 +867,35 @@ def main():
         # logging to a file, dump the config settings there as well
         mds_config.log(app, "mdserver")
 
+    # check the server choice before touching the database or the dnsmasq
+    # config, so a bad choice doesn't leave things half set up
+    server = app.config["mdserver.server"]
+    server_error = check_server(server)
+    if server_error is not None:
+        logger.error("%s, exiting", server_error)
+        sys.exit(1)
+
     install(log_to_logger)
 
-    db = Database(app.config["mdserver.db_file"])
-    # update the database with our location data
-    location = Database.new_location(
-        app.config["service.hostname"], app.config["service.version"]
-    )
-    db.add_or_update_location(app.config["service.location"], location)
-    db.store()
-    dnsmasq = Dnsmasq(app.config)
-    dnsmasq.gen_dnsmasq_config()
-    dnsmasq.gen_dhcp_hosts(db)
-    dnsmasq.gen_dns_hosts(db)
+    with Database.lock(app.config["mdserver.db_file"]):
+        db = Database(app.config["mdserver.db_file"])
+        # update the database with our location data
+        location = Database.new_location(
+            app.config["service.hostname"], app.config["service.version"]
+        )
+        db.add_or_update_location(app.config["service.location"], location)
+        db.store()
+        dnsmasq = Dnsmasq(app.config)
+        dnsmasq.gen_dnsmasq_config()
+        dnsmasq.gen_dhcp_hosts(db)
+        dnsmasq.gen_dns_hosts(db)
 
     if app.config["public-keys.default"] == "__NOT_CONFIGURED__":
         logger.info("============Default public key not set !!!=============")
 
     mdh = MetadataHandler()
+    mdh._get_db(app.config)
+    mdh.dnsmasq_updater = DnsmasqUpdater(app.config)
 
     if app.config["mdserver.default_template"]:
         mdh._set_default_template(app.config["mdserver.default_template"])
@@ -497,6 +907,11 @@ def main():
     app.config["dnsmasq.domain"] = strtobool_or_val(domain)
 
     mdh._set_public_keys(app.config)
+    mdh._set_ec2_versions(app.config)
+    mdh._set_template_data(app.config)
+    mdh._set_userdata_suffixes(app.config)
+    mdh._set_template_context(app.config)
+    mdh._set_config_content(app)
 
     route("/", "GET", mdh.gen_versions)
     route("/service/", "GET", mdh.gen_service_info)
@@ -507,33 +922,25 @@ def main():
     route("/service/configuration", "GET", mdh.gen_service_config)
     route("/service/ec2_versions", "GET", mdh.gen_ec2_versions)
 
-    for md_base in mdh._get_ec2_versions(app.config):
-        # skip empty strings - it makes no sense to put metadata directly
-        # under /
-        if len(md_base) == 0:
-            continue
-        # make sure the path is always properly rooted
-        if len(md_base) > 0 and md_base[0] != "/":
-            md_base = "/" + md_base
-        route(md_base + "/", "GET", mdh.gen_base)
-        route(md_base + "/meta-data/", "GET", mdh.gen_metadata)
-        route(md_base + "/user-data", "GET", mdh.gen_userdata)
-        route(md_base + "/meta-data/hostname", "GET", mdh.gen_hostname)
-        route(md_base + "/meta-data/instance-id", "GET", mdh.gen_instance_id)
-        route(md_base + "/meta-data/public-keys/", "GET", mdh.gen_public_keys)
-        route(md_base + "/meta-data/public-keys/<key>/", "GET", mdh.gen_public_key_dir)
-        route(
-            (md_base + "/meta-data/public-keys/<key>/openssh-key"),
-            "GET",
-            mdh.gen_public_key_file,
-        )
+    add_metadata_routes(app, mdh)
 
     # support for uploading instance data
     route("/instance-upload", "POST", mdh.instance_upload)
 
     svr_port = app.config.get("mdserver.port")
     listen_addr = app.config.get("mdserver.listen_address")
-    run(host=listen_addr, port=svr_port)
+    workers = int(app.config["mdserver.workers"])
+    if workers > 1:
+        if server == "wsgiref":
+            if not run_workers(listen_addr, svr_port, workers):
+                sys.exit(1)
+            return
+        logger.warning(
+            "Multiple workers are only supported with the wsgiref server, "
+            "running a single %s server",
+            server,
+        )
+    run(server=server, host=listen_addr, port=svr_port)
 
 
 if __name__ == "__main__":
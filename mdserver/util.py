@@ -3,21 +3,23 @@
 #
 # Please see the LICENSE.txt file for details.
 
-import sys
-from distutils.util import strtobool
+_TRUE_VALUES = frozenset(["y", "yes", "t", "true", "on", "1"])
+_FALSE_VALUES = frozenset(["n", "no", "f", "false", "off", "0"])
 
 
-def _removeprefix(text, prefix):
-    """Remove prefix from text if found.
+def strtobool(string):
+    """Convert a string representation of truth to 1 (true) or 0 (false).
 
-    For backwards compatibility with Python versions prior to 3.9.
+    A replacement for distutils.util.strtobool(), which is not available from
+    Python 3.12 onwards. Raises ValueError if the string is not recognised.
     """
-    if sys.version_info.minor >= 9:
-        return text.removeprefix(prefix)
-    if text.startswith(prefix):
-        return text[len(prefix) :]
+    val = string.lower()
+    if val in _TRUE_VALUES:
+        return 1
+    elif val in _FALSE_VALUES:
+        return 0
     else:
-        return text
+        raise ValueError("invalid truth value %r" % (string,))
 
 
 def strtobool_or_val(string):
@@ -1,10 +1,26 @@
 # /usr/bin/env python
 
+import logging
+import os
+import re
+import tempfile
+import time
 import unittest
 from unittest.mock import patch
+from wsgiref.util import setup_testing_defaults
+
+import bottle
 
 from mdserver.database import JsonDatabase as Database
 from mdserver.libvirt import get_domain_data
+from mdserver.server import LOGLEVELS
+from mdserver.server import DnsmasqUpdater
+from mdserver.server import MetadataHandler
+from mdserver.server import add_metadata_routes
+from mdserver.server import get_loglevel
+from mdserver.server import read_template
+from mdserver.util import strtobool
+from mdserver.util import strtobool_or_val
 
 # Note: this is /not/ a usable domain definition!
 domxml = """
@@ -75,6 +91,44 @@ domxml = """
 </domain>
 """  # noqa: 501
 
+# minimal domain definition, with the metadata element to be filled in
+metaxml = """
+<domain type='kvm'>
+  <name>meta</name>
+  <uuid>4c4bd3a3-52a0-4a3b-9b53-fd0e1bb0b2b1</uuid>
+  %s
+  <devices>
+    <interface type='network'>
+      <mac address='52:54:00:3a:cf:42'/>
+      <source network='mds'/>
+    </interface>
+  </devices>
+</domain>
+"""
+
+
+def wsgi_get(app, path):
+    """Make a GET request for path to the app, returning the status and body."""
+    environ = {"PATH_INFO": path}
+    setup_testing_defaults(environ)
+    status = []
+    body = app(environ, lambda s, h, e=None: status.append(s))
+    return (status[0], b"".join(body))
+
+
+def write_file(path, content, age=None):
+    """Write a file, optionally setting its mtime to `age` seconds ago."""
+    with open(path, "w") as f:
+        f.write(content)
+    if age is not None:
+        set_age(path, age)
+
+
+def set_age(path, age):
+    mtime = time.time_ns() - int(age * 1000000000)
+    os.utime(path, ns=(mtime, mtime))
+
+
 db_entry = {
     "location": "testing_123",
     "domain_name": "test",
@@ -101,6 +155,43 @@ class test_all(unittest.TestCase):
         self.assertEqual(dbentry["mds_ipv4"], None)
         self.assertEqual(dbentry["mds_ipv6"], None)
 
+    # mdserver metadata is identified by the namespace bound to the mdserver
+    # prefix, wherever it's declared
+    def test_get_domain_data_metadata_child_ns(self):
+        metadata = """
+  <metadata>
+    <mdserver:userdata_prefix xmlns:mdserver="urn:md_server:domain_metadata">bar</mdserver:userdata_prefix>
+  </metadata>"""  # noqa: 501
+        dbentry = get_domain_data(metaxml % metadata, "mds")
+        self.assertEqual(dbentry["domain_metadata"], {"userdata_prefix": "bar"})
+
+    # metadata in other namespaces must be ignored, even with the same name
+    def test_get_domain_data_metadata_foreign_ns(self):
+        metadata = """
+  <metadata xmlns:mdserver="urn:md_server:domain_metadata" xmlns:other="urn:other">
+    <mdserver:userdata_prefix>testing</mdserver:userdata_prefix>
+    <other:userdata_prefix>wrong</other:userdata_prefix>
+    <other:foo>bar</other:foo>
+  </metadata>"""
+        dbentry = get_domain_data(metaxml % metadata, "mds")
+        self.assertEqual(dbentry["domain_metadata"], {"userdata_prefix": "testing"})
+
+    # domains without an interface on the mds network should be ignored
+    def test_get_domain_data_no_mds_interface(self):
+        no_interfaces = re.sub(r"<interface.*?</interface>", "", domxml, flags=re.S)
+        self.assertIsNone(get_domain_data(no_interfaces, "mds"))
+        other_network = domxml.replace("network='mds'", "network='mds-other'")
+        self.assertIsNone(get_domain_data(other_network, "mds"))
+        self.assertIsNone(get_domain_data(domxml, "mds-other"))
+
+    # the upload handler passes the raw request body through as bytes
+    def test_get_domain_data_bytes(self):
+        dbentry = get_domain_data(domxml.encode(), "mds")
+        self.assertEqual(dbentry["domain_name"], "test")
+        self.assertEqual(dbentry["mds_mac"], "52:54:00:3a:cf:41")
+        self.assertEqual(dbentry["domain_metadata"]["userdata_prefix"], "testing")
+        self.assertIsNone(get_domain_data(domxml.encode(), "mds-other"))
+
     # test IP address generation and allocation
     @patch("random.seed")
     @patch("random.randrange")
@@ -117,6 +208,214 @@ class test_all(unittest.TestCase):
         self.assertEqual(new_entry["mds_ipv4"], "10.122.5.220")
         self.assertEqual(new_entry["mds_ipv6"], "2001:db8::16:e360")
 
+    # strtobool should match the behaviour of the distutils version
+    def test_strtobool(self):
+        for val in ["y", "yes", "t", "true", "on", "1"]:
+            self.assertEqual(strtobool(val), 1)
+            self.assertEqual(strtobool(val.upper()), 1)
+            self.assertEqual(strtobool(val.capitalize()), 1)
+        for val in ["n", "no", "f", "false", "off", "0"]:
+            self.assertEqual(strtobool(val), 0)
+            self.assertEqual(strtobool(val.upper()), 0)
+            self.assertEqual(strtobool(val.capitalize()), 0)
+        self.assertIs(type(strtobool("TrUe")), int)
+        self.assertIs(type(strtobool("fAlSe")), int)
+        for val in ["", "2", "maybe", "yess", " yes"]:
+            self.assertRaises(ValueError, strtobool, val)
+
+    def test_strtobool_or_val(self):
+        self.assertEqual(strtobool_or_val("Yes"), 1)
+        self.assertEqual(strtobool_or_val("off"), 0)
+        self.assertIs(strtobool_or_val(True), True)
+        self.assertIs(strtobool_or_val(False), False)
+        self.assertEqual(strtobool_or_val("mds-"), "mds-")
+        self.assertEqual(strtobool_or_val("example.com"), "example.com")
+
+    # public keys can be requested by index or by name, with the index taking
+    # precedence, and unknown keys are not found
+    def test_public_key_file(self):
+        app = bottle.Bottle()
+        # note that the key named "2" is the key with index 0
+        app.config["public-keys.2"] = "key two"
+        app.config["public-keys.default"] = "default key"
+        app.config["public-keys.other"] = "other key"
+        mdh = MetadataHandler()
+        mdh._set_public_keys(app.config)
+        app.route("/public-keys/<key>/openssh-key", "GET", mdh.gen_public_key_file)
+
+        def get(key):
+            return wsgi_get(app, "/public-keys/%s/openssh-key" % (key))
+
+        self.assertEqual(get("0"), ("200 OK", b"key two"))
+        self.assertEqual(get("1"), ("200 OK", b"default key"))
+        self.assertEqual(get("default"), ("200 OK", b"default key"))
+        self.assertEqual(get("other"), ("200 OK", b"other key"))
+        self.assertEqual(get("2"), ("200 OK", b"other key"))
+        self.assertEqual(get("3")[0], "404 Not Found")
+        self.assertEqual(get("nope")[0], "404 Not Found")
+
+    # metadata routes are registered for each configured EC2 version, and
+    # nothing else
+    def test_metadata_routes(self):
+        app = bottle.Bottle()
+        app.config["service.ec2_versions"] = "2009-04-04, latest"
+        app.config["public-keys.default"] = "default key"
+        mdh = MetadataHandler()
+        mdh._set_ec2_versions(app.config)
+        mdh._set_public_keys(app.config)
+        add_metadata_routes(app, mdh)
+
+        self.assertEqual(
+            wsgi_get(app, "/latest/meta-data/"),
+            ("200 OK", b"instance-id\nhostname\npublic-keys/"),
+        )
+        self.assertEqual(
+            wsgi_get(app, "/2009-04-04/meta-data/public-keys/0/openssh-key"),
+            ("200 OK", b"default key"),
+        )
+        self.assertEqual(
+            wsgi_get(app, "/latest/meta-data/public-keys/default/"),
+            ("200 OK", b"openssh-key"),
+        )
+        for path in [
+            "/bogus/meta-data/",
+            "/bogus/meta-data/public-keys/0/openssh-key",
+            "/latestx/meta-data/public-keys/0/openssh-key",
+            "/2009-04-04x/meta-data/public-keys/0/",
+        ]:
+            self.assertEqual(wsgi_get(app, path)[0], "404 Not Found", path)
+
+    # template contents are cached until the file changes
+    def test_read_template(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            name = os.path.join(tmpdir, "template")
+            write_file(name, "aaa", age=10)
+            self.assertEqual(read_template(name), "aaa")
+            # edited in place, same size
+            write_file(name, "bbb", age=5)
+            self.assertEqual(read_template(name), "bbb")
+
+    # recently modified templates aren't cached, since a second edit within
+    # the same timestamp tick might not change the mtime
+    def test_read_template_recent(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            name = os.path.join(tmpdir, "template")
+            write_file(name, "aaa")
+            st = os.stat(name)
+            self.assertEqual(read_template(name), "aaa")
+            write_file(name, "bbb")
+            os.utime(name, ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.assertEqual(read_template(name), "bbb")
+
+    # userdata directory listings are cached until the directory changes
+    def test_list_userdata_dir(self):
+        mdh = MetadataHandler()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_file(os.path.join(tmpdir, "a"), "a")
+            set_age(tmpdir, 10)
+            self.assertEqual(mdh._list_userdata_dir(tmpdir), {"a"})
+            self.assertIn(tmpdir, mdh._userdata_dirs)
+            # a new file changes the directory's mtime
+            write_file(os.path.join(tmpdir, "b"), "b")
+            self.assertEqual(mdh._list_userdata_dir(tmpdir), {"a", "b"})
+            # and so does removing one
+            os.unlink(os.path.join(tmpdir, "a"))
+            set_age(tmpdir, 5)
+            self.assertEqual(mdh._list_userdata_dir(tmpdir), {"b"})
+            # missing directories have no files
+            missing = os.path.join(tmpdir, "missing")
+            self.assertEqual(mdh._list_userdata_dir(missing), frozenset())
+
+    # recently modified directories aren't cached
+    def test_list_userdata_dir_recent(self):
+        mdh = MetadataHandler()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_file(os.path.join(tmpdir, "a"), "a")
+            st = os.stat(tmpdir)
+            self.assertEqual(mdh._list_userdata_dir(tmpdir), {"a"})
+            self.assertNotIn(tmpdir, mdh._userdata_dirs)
+            write_file(os.path.join(tmpdir, "b"), "b")
+            os.utime(tmpdir, ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.assertEqual(mdh._list_userdata_dir(tmpdir), {"a", "b"})
+
+    # a userdata file edited in place after both the directory listing and
+    # the file contents were cached is picked up
+    def test_userdata_template_edit(self):
+        mdh = MetadataHandler()
+        mdh.userdata_suffixes = ("", ".yaml")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {"mdserver.userdata_dir": tmpdir}
+            name = os.path.join(tmpdir, "test.yaml")
+            write_file(name, "aaa", age=10)
+            set_age(tmpdir, 10)
+            found = mdh._try_userdata_template("test", "10.0.0.1", config)
+            self.assertEqual(found, name)
+            self.assertEqual(read_template(found), "aaa")
+            write_file(name, "bbb", age=5)
+            found = mdh._try_userdata_template("test", "10.0.0.1", config)
+            self.assertEqual(found, name)
+            self.assertEqual(read_template(found), "bbb")
+            self.assertIsNone(mdh._try_userdata_template("nope", "10.0.0.1", config))
+
+    # the dnsmasq host files are only regenerated when the host data changes
+    @patch("mdserver.server.Dnsmasq")
+    def test_dnsmasq_update(self, dnsmasq):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, "db.json")
+            db = Database(dbfile)
+            db.add_or_update_entry(dict(db_entry))
+            db.store()
+            updater = DnsmasqUpdater({"mdserver.db_file": dbfile})
+            updater.update()
+            updater.update()
+            self.assertEqual(dnsmasq.return_value.gen_dhcp_hosts.call_count, 1)
+            self.assertEqual(dnsmasq.return_value.gen_dns_hosts.call_count, 1)
+            self.assertEqual(dnsmasq.return_value.hup.call_count, 1)
+            # changes to fields that don't appear in the host files are ignored
+            db = Database(dbfile)
+            db.add_or_update_entry(dict(db_entry, location="elsewhere"))
+            db.store()
+            updater.update()
+            self.assertEqual(dnsmasq.return_value.hup.call_count, 1)
+            db = Database(dbfile)
+            db.add_or_update_entry(dict(db_entry, mds_ipv4="10.122.5.220"))
+            db.store()
+            updater.update()
+            self.assertEqual(dnsmasq.return_value.gen_dhcp_hosts.call_count, 2)
+            self.assertEqual(dnsmasq.return_value.gen_dns_hosts.call_count, 2)
+            self.assertEqual(dnsmasq.return_value.hup.call_count, 2)
+
+    # a burst of update requests is handled by a single update
+    def test_dnsmasq_update_coalescing(self):
+        updater = DnsmasqUpdater({}, delay=0.2)
+        with patch.object(updater, "update") as update:
+            for _ in range(5):
+                updater.request()
+            time.sleep(0.5)
+            self.assertEqual(update.call_count, 1)
+            # and a later request gets another update
+            updater.request()
+            time.sleep(0.5)
+            self.assertEqual(update.call_count, 2)
+
+    # log level names are case insensitive, and unknown names fall back to
+    # INFO with a warning
+    def test_get_loglevel(self):
+        config = {
+            "lower": "debug",
+            "notset": "NotSet",
+            "fatal": "fatal",
+            "unknown": "verbose",
+        }
+        self.assertEqual(get_loglevel(config, "lower"), "DEBUG")
+        self.assertEqual(get_loglevel(config, "notset"), "NOTSET")
+        self.assertEqual(LOGLEVELS["NOTSET"], logging.NOTSET)
+        self.assertEqual(get_loglevel(config, "fatal"), "FATAL")
+        self.assertEqual(LOGLEVELS["FATAL"], logging.FATAL)
+        with self.assertLogs("early_logger", level="WARNING") as logs:
+            self.assertEqual(get_loglevel(config, "unknown"), "INFO")
+        self.assertIn("VERBOSE", logs.output[0])
+
 
 if __name__ == "__main__":
     unittest.main()